@@ -1,10 +1,23 @@
 import streamlit as st
-import camelot
 import pandas as pd
-import pdfplumber
+import numpy as np
+import pypdfium2 as pdfium
+import xlsxwriter
 import io
+import re
 import os
 import tempfile
+import shutil
+import hashlib
+import time
+import itertools
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import workers
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(page_title="BBS PDF Convertor", page_icon="📊", layout="wide")
@@ -21,28 +34,197 @@ st.markdown("""
 
 HEADERS = ["Bar Mark", "Type", "Size", "Total No.", "Shape No.", "a", "b", "c", "d", "e", "f", "g", "h", "i"]
 KEY_COLUMNS = ["Bar Mark", "Type", "Size", "Total No.", "Shape No."]
+# Low-cardinality columns (a handful of bar types/sizes/shapes) stored as categoricals
+CATEGORICAL_COLUMNS = ["Type", "Size", "Shape No."]
+
+# Camelot/Ghostscript is not thread-safe, so pages are farmed out to worker processes
+# sched_getaffinity only counts the CPUs this process may run on (pinning, cpusets)
+_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+MAX_WORKERS = min(_CPUS, 4)
+PAGES_PER_BATCH = 5
+# The BBS header is expected near the front; don't scan enormous PDFs end to end
+MAX_SCAN_PAGES = 20
+# Bounded hand-off between pipeline stages, so a fast stage can't run far ahead of a slow one
+STAGE_QUEUE_SIZE = 8
+# How often a blocked stage re-checks whether its consumer has gone away
+STAGE_PUT_TIMEOUT = 0.1
+
+# On Linux, keep the uploaded PDF and Ghostscript's page renders in RAM (tmpfs) when it has room
+SHM_DIR = "/dev/shm"
+# Headroom each Camelot worker may need for page renders, on top of the PDF itself
+SHM_RENDER_BYTES_PER_WORKER = 32 * 1024 * 1024
+
+# Compiled once and reused for every column of every table
+_WS_RE = re.compile(r'\s+')
 
 # --- YOUR ORIGINAL LOGIC (PORTED FROM RUN.PY) ---
 
 def find_start_page(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        for i, page in enumerate(pdf.pages):
-            text = " ".join(w["text"].lower() for w in page.extract_words(use_text_flow=True))
+    # pdfium's C text extraction is much cheaper than pdfminer for a plain keyword scan
+    with pdfium.PdfDocument(pdf_path) as pdf:
+        for i in range(min(MAX_SCAN_PAGES, len(pdf))):
+            text = pdf[i].get_textpage().get_text_range().lower()
             if "bar" in text and "mark" in text:
                 return i + 1
     return None
 
+def count_pages(pdf_path):
+    with pdfium.PdfDocument(pdf_path) as pdf:
+        return len(pdf)
+
+def page_batches(start_page, last_page):
+    # Spread pages evenly over the workers, at most PAGES_PER_BATCH pages per Camelot call
+    n_pages = last_page - start_page + 1
+    size = max(1, min(PAGES_PER_BATCH, -(-n_pages // MAX_WORKERS)))
+    return [f"{p}-{min(p + size - 1, last_page)}" for p in range(start_page, last_page + 1, size)]
+
+def scratch_dir(pdf_size):
+    # tmpfs (often only 64 MB in containers) if it fits the PDF plus every worker's renders;
+    # None means the default temp dir
+    try:
+        free = shutil.disk_usage(SHM_DIR).free
+    except OSError:
+        return None
+    return SHM_DIR if free >= pdf_size + MAX_WORKERS * SHM_RENDER_BYTES_PER_WORKER else None
+
+def write_temp_pdf(pdf_bytes, dir=None):
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf", dir=dir)
+    try:
+        with tmp:
+            tmp.write(pdf_bytes)
+    except OSError:
+        os.remove(tmp.name)
+        raise
+    return tmp.name
+
+def iter_page_tables(pdf_path, start_page, progress=None, scratch=None):
+    batches = page_batches(start_page, count_pages(pdf_path))
+    n = len(batches)
+
+    def report(done, found):
+        # The stream pass only counts towards the total once lattice has come up empty
+        if progress:
+            progress(done, n if found else 2 * n)
+
+    if n <= 1 or MAX_WORKERS == 1:
+        # Spawned workers each re-import camelot/cv2, which a single batch or a single CPU
+        # never wins back; run the batches here, lattice first and stream only if that's empty
+        found = False
+        for done, b in enumerate(batches, start=1):
+            tables = workers.read_frames(pdf_path, b, "lattice")
+            found = found or bool(tables)
+            report(done, found)
+            yield tables
+        if not found:
+            for done, b in enumerate(batches, start=1):
+                tables = workers.read_frames(pdf_path, b, "stream")
+                report(n + done, False)
+                yield tables
+        return
+
+    # "spawn" keeps the workers from forking the running Streamlit server
+    ctx = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(max_workers=min(MAX_WORKERS, 2 * n), mp_context=ctx,
+                               initializer=workers.init_worker, initargs=(scratch,))
+    try:
+        # Grid extraction is preferred; stream is queued right behind it as the fallback so it
+        # starts on idle workers, and is cancelled as soon as lattice finds a table
+        lattice = [pool.submit(workers.read_frames, pdf_path, b, "lattice") for b in batches]
+        stream = [pool.submit(workers.read_frames, pdf_path, b, "stream") for b in batches]
+
+        found = False
+        # Results are yielded in submission order so tables stay in page order
+        for done, f in enumerate(lattice, start=1):
+            tables = f.result()
+            if tables and not found:
+                found = True
+                for s in stream:
+                    s.cancel()
+            report(done, found)
+            yield tables
+        if found:
+            return
+
+        for done, f in enumerate(stream, start=1):
+            tables = f.result()
+            report(n + done, False)
+            yield tables
+    finally:
+        # Stream batches that were already running can't be cancelled; wait for them so no
+        # worker is still reading pdf_path when the caller deletes it
+        pool.shutdown(wait=True, cancel_futures=True)
+
+_STAGE_DONE = object()
+
+def _put_stage(q, item, stop):
+    # Blocks until the consumer takes the item; gives up once the consumer has stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=STAGE_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _feed_stage(source, q, stop, upstream):
+    try:
+        for item in source:
+            if not _put_stage(q, item, stop):
+                break
+    except Exception as e:
+        # Re-raised on the consuming side
+        _put_stage(q, e, stop)
+    finally:
+        # Lets generator sources run their cleanup (e.g. shutting down the Camelot pool), and
+        # stops the stage feeding this one, which nobody will read from any more
+        source.close()
+        if upstream is not None:
+            upstream.close()
+        _put_stage(q, _STAGE_DONE, stop)
+
+def _drain_stage(q, stop, feeder):
+    try:
+        while True:
+            item = q.get()
+            if item is _STAGE_DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Wait for the feeder's cleanup, so nothing still reads the PDF once we return
+        stop.set()
+        feeder.join()
+
+def run_stage(source, upstream=None):
+    # Drives a generator on its own thread and returns a generator over its output; closing
+    # that (or abandoning it on an error) stops the thread. upstream is the run_stage
+    # generator that source reads from, so the whole chain winds down together
+    q = queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+    stop = threading.Event()
+    feeder = threading.Thread(target=_feed_stage, args=(source, q, stop, upstream), daemon=True)
+    feeder.start()
+    return _drain_stage(q, stop, feeder)
+
 def find_header_row(df):
-    for idx, row in df.iterrows():
-        row_text = " ".join(row.astype(str).str.lower())
-        if "bar mark" in row_text and ("shape code" in row_text or "shape no" in row_text):
-            return idx
-    return None
+    # Lowercase the whole table in one NumPy call; returns a positional index for df.iloc
+    arr = np.char.lower(df.to_numpy(dtype=str, na_value=''))
+    joined = np.array([" ".join(row) for row in arr.tolist()], dtype=str)
+    hits = (np.char.find(joined, "bar mark") >= 0) & (
+        (np.char.find(joined, "shape code") >= 0) | (np.char.find(joined, "shape no") >= 0)
+    )
+    return int(np.argmax(hits)) if hits.any() else None
+
+def nonempty_cells(df):
+    # 2-D bool matrix, True where a cell has content after stripping; shared by the row filters
+    arr = df.to_numpy(dtype=str, na_value='')
+    return np.char.str_len(np.char.strip(arr)) > 0
 
-def remove_sparse_rows(df, threshold=0.5):
-    n_cols = len(df.columns)
-    mask = df.apply(lambda row: (row.fillna('').astype(str).str.strip() != '').sum() / n_cols > (1 - threshold), axis=1)
-    return df[mask]
+def dense_rows_mask(nonempty, threshold=0.5):
+    n_cols = nonempty.shape[1]
+    if n_cols == 0:
+        return np.ones(len(nonempty), dtype=bool)
+    return nonempty.sum(axis=1) / n_cols > (1 - threshold)
 
 def make_columns_unique(cols):
     seen = {}
@@ -55,64 +237,120 @@ def make_columns_unique(cols):
 
 def clean_dataframe(df):
     df = df.dropna(axis=1, how='all')
-    for col in df.select_dtypes(include="object"):
-        df[col] = df[col].astype(str).str.replace(r'\s+', ' ', regex=True).str.strip()
+    for col in df.columns:
+        # Collapse whitespace in plain Python; non-string cells are left untouched
+        df[col] = [_WS_RE.sub(' ', s).strip() if isinstance(s, str) else s for s in df[col].tolist()]
     return df
 
-def filter_key_rows(df):
+def key_rows_mask(df, nonempty):
     required_cols = ["Bar Mark", "Type", "Size", "Total No.", "Shape No."]
-    required_cols = [c for c in required_cols if c in df.columns]
-    if not required_cols:
-        return df
-    mask = df[required_cols].apply(lambda x: x.astype(str).str.strip() != '').all(axis=1)
-    return df[mask]
+    col_idx = [df.columns.get_loc(c) for c in required_cols if c in df.columns]
+    if not col_idx:
+        return np.ones(len(df), dtype=bool)
+    return nonempty[:, col_idx].all(axis=1)
 
-def extract_tables(uploaded_file):
+def iter_clean_tables(tables):
+    # Pulls tables (raw cell DataFrames) one at a time so each can be freed once it has been cleaned
+    current_headers = None
+    for raw in tables:
+        # One C-level pass over the cell array instead of a regex replace per cell
+        df = pd.DataFrame(np.char.replace(raw.to_numpy(dtype=str, na_value=""), "\n", " "),
+                          index=raw.index, columns=raw.columns)
+        del raw
+        header_idx = find_header_row(df)
+        
+        if header_idx is not None:
+            current_headers = df.iloc[header_idx].str.strip()
+            df = df.iloc[header_idx+1:].copy()
+        
+        if current_headers is not None and len(df.columns) == len(current_headers):
+            df.columns = current_headers
+        
+        df.columns = make_columns_unique(df.columns)
+        df = clean_dataframe(df)
+        
+        # Every filter is per-row, so one emptiness pass feeds all of them and they AND together
+        nonempty = nonempty_cells(df)
+        keep = key_rows_mask(df, nonempty) & dense_rows_mask(nonempty, threshold=0.5)
+        if "Bar Mark" in df.columns:
+            keep &= nonempty[:, df.columns.get_loc("Bar Mark")]
+        df = df[keep]
+        
+        if not df.empty: 
+            yield df
+
+def to_excel_bytes(df):
+    # constant_memory flushes each row as it is written, so rows must go out top to bottom;
+    # pandas' to_excel emits cells column by column, hence writing the rows directly here
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True, "strings_to_numbers": False})
+    worksheet = workbook.add_worksheet()
+    # Plain header row, as pandas' to_excel writes it
+    worksheet.write_row(0, 0, [str(c) for c in df.columns])
+    rows = df.astype(object).where(df.notna(), "")
+    for r, row in enumerate(rows.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(r, 0, row)
+    workbook.close()
+    return output.getvalue()
+
+def extract_tables(uploaded_file, progress=None):
+    return _extract_tables_from_bytes(uploaded_file.getvalue(), progress)
+
+# Keyed on the PDF bytes, so reruns and repeat uploads of the same file skip re-parsing
+# (the leading underscore keeps the progress callback out of the cache key)
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def _extract_tables_from_bytes(pdf_bytes, _progress=None):
     # Save uploaded file to a temporary location for Camelot
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-        tmp.write(uploaded_file.getvalue())
-        tmp_path = tmp.name
+    scratch = scratch_dir(len(pdf_bytes))
+    try:
+        tmp_path = write_temp_pdf(pdf_bytes, scratch)
+    except OSError:
+        if scratch is None:
+            raise
+        # tmpfs filled up after the free-space check; fall back to the default temp dir
+        scratch = None
+        tmp_path = write_temp_pdf(pdf_bytes)
 
     try:
         start_page = find_start_page(tmp_path)
         if not start_page: return None
 
-        # Try grid extraction first
-        tables = camelot.read_pdf(tmp_path, pages=f"{start_page}-end", flavor="lattice")
-        if tables.n == 0:
-            tables = camelot.read_pdf(tmp_path, pages=f"{start_page}-end", flavor="stream")
-
-        all_tables = []
-        current_headers = None
-
-        for table in tables:
-            df = table.df.replace("\n", " ", regex=True)
-            header_idx = find_header_row(df)
-            
-            if header_idx is not None:
-                current_headers = df.iloc[header_idx].str.strip()
-                df = df.iloc[header_idx+1:].copy()
-            
-            if current_headers is not None and len(df.columns) == len(current_headers):
-                df.columns = current_headers
-            
-            df.columns = make_columns_unique(df.columns)
-            df = clean_dataframe(df)
-            df = filter_key_rows(df)
-            df = remove_sparse_rows(df, threshold=0.5)
-            
-            if "Bar Mark" in df.columns:
-                df = df[df["Bar Mark"].astype(str).str.strip() != '']
-            
-            if not df.empty: 
-                all_tables.append(df)
-        
-        final_df = pd.concat(all_tables, ignore_index=True, sort=False) if all_tables else None
+        # Three stages overlap: Camelot batches -> per-table cleaning -> concat on this thread
+        batches = run_stage(iter_page_tables(tmp_path, start_page, _progress, scratch))
+        frames = run_stage(iter_clean_tables(itertools.chain.from_iterable(batches)), upstream=batches)
+        try:
+            first = next(frames, None)
+            if first is None:
+                return None
+            final_df = pd.concat(itertools.chain([first], frames), ignore_index=True, sort=False)
+        finally:
+            frames.close()
+        # Blank out stringified missing values once here rather than on every preview rerun
+        final_df = final_df.replace({'nan': '', 'None': '', 'NaN': ''})
+        for c in CATEGORICAL_COLUMNS:
+            if c in final_df:
+                final_df[c] = final_df[c].astype("category")
         return final_df
     finally:
         if os.path.exists(tmp_path):
             os.remove(tmp_path)
 
+class ExtractionCancelled(Exception):
+    pass
+
+def start_extraction(uploaded_file, key):
+    # Runs extract_tables off the script thread so the UI stays live and reruns don't restart it
+    job = {"key": key, "progress": 0.0, "cancel": threading.Event()}
+    def on_progress(done, total):
+        # Checked after every Camelot batch; raising unwinds the pipeline and stops the workers
+        if job["cancel"].is_set():
+            raise ExtractionCancelled()
+        job["progress"] = done / total
+    executor = ThreadPoolExecutor(max_workers=1, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()))
+    job["future"] = executor.submit(extract_tables, uploaded_file, on_progress)
+    executor.shutdown(wait=False)
+    return job
+
 # --- STREAMLIT UI ---
 
 st.markdown("<div class='header-text'>", unsafe_allow_html=True)
@@ -123,65 +361,94 @@ st.markdown("</div>", unsafe_allow_html=True)
 uploaded_file = st.file_uploader("Upload your BBS PDF file", type="pdf")
 
 if uploaded_file:
-    # We use session state to remember the data across clicks
-    if 'data' not in st.session_state:
-        with st.spinner('Scanning pages for tables...'):
-            st.session_state.data = extract_tables(uploaded_file)
-    
-    df = st.session_state.data
-
-    if df is not None and not df.empty:
-        st.success(f"✓ Successfully extracted {len(df)} rows of data.")
-        
-        # 1. Preview Area
-        st.subheader("1. Data Preview")
-        # Replace 'nan' strings with empty for a clean preview
-        display_df = df.replace('nan', '', regex=True)
-        st.dataframe(display_df, use_container_width=True, height=400)
-
-        # 2. Mapping Area
-        st.subheader("2. Map Columns to Standard Format")
-        mapping = {}
-        m_cols = st.columns(4)
-        for i, h in enumerate(HEADERS):
-            with m_cols[i % 4]:
-                # Streamlit selectbox for column mapping
-                mapping[h] = st.selectbox(
-                    f"**{h}**", 
-                    options=["(Ignore)"] + list(df.columns), 
-                    key=f"map_{h}"
-                )
+    # The job lives in session state, so widget reruns pick up the running extraction
+    pdf_key = hashlib.md5(uploaded_file.getvalue()).hexdigest()
+    job = st.session_state.get("extraction")
+    if job is None or job["key"] != pdf_key:
+        if job is not None:
+            # A new file replaces the old one; stop its extraction instead of running both
+            job["cancel"].set()
+        job = st.session_state.extraction = start_extraction(uploaded_file, pdf_key)
+
+    if not job["future"].done() and not job["cancel"].is_set():
+        with st.status("Scanning pages for tables...", expanded=True) as status:
+            bar = st.progress(job["progress"])
+            cancel_slot = st.empty()
+            if cancel_slot.button("✖ Cancel extraction"):
+                job["cancel"].set()
+                job["future"].cancel()
+                st.rerun()
+            while not job["future"].done():
+                bar.progress(job["progress"])
+                time.sleep(0.2)
+            cancel_slot.empty()
+            status.update(label="Scan complete", state="complete", expanded=False)
 
-        # 3. Export Area
-        st.markdown("<br>", unsafe_allow_html=True)
-        if st.button("🚀 Process & Generate Excel"):
-            # Build output DataFrame based on user mapping
-            final_dict = {}
-            for h, mapped_col in mapping.items():
-                if mapped_col != "(Ignore)":
-                    final_dict[h] = df[mapped_col]
-                else:
-                    final_dict[h] = ""
-            
-            out_df = pd.DataFrame(final_dict)
-            
-            # Save to Excel buffer
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                out_df.to_excel(writer, index=False)
-            
-            st.session_state.xlsx_output = output.getvalue()
-            st.balloons()
-
-        if 'xlsx_output' in st.session_state:
-            st.download_button(
-                label="📥 Download Excel File",
-                data=st.session_state.xlsx_output,
-                file_name="bbs_converted_data.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+    if job["cancel"].is_set():
+        if not job["future"].done():
+            # Cancel only lands at the next batch checkpoint; no Restart until the old run has stopped
+            with st.spinner("Cancelling…"):
+                while not job["future"].done():
+                    time.sleep(0.2)
+        st.warning("Extraction cancelled.")
+        if st.button("🔄 Restart extraction"):
+            del st.session_state.extraction
+            st.rerun()
+    elif job["future"].exception() is not None:
+        # Forget the failed job so the next rerun (e.g. the retry button) starts a fresh attempt
+        del st.session_state.extraction
+        st.error(f"Extraction failed: {job['future'].exception()}")
+        st.button("🔄 Retry extraction")
     else:
-        st.error("No valid BBS tables found. Ensure the PDF contains headers like 'Bar Mark' and 'Type'.")
+        df = job["future"].result()
+
+        if df is not None and not df.empty:
+            st.success(f"✓ Successfully extracted {len(df)} rows of data.")
+        
+            # 1. Preview Area
+            st.subheader("1. Data Preview")
+            st.dataframe(df, use_container_width=True, height=400)
+
+            # 2. Mapping Area
+            st.subheader("2. Map Columns to Standard Format")
+            mapping = {}
+            m_cols = st.columns(4)
+            for i, h in enumerate(HEADERS):
+                with m_cols[i % 4]:
+                    # Streamlit selectbox for column mapping
+                    mapping[h] = st.selectbox(
+                        f"**{h}**", 
+                        options=["(Ignore)"] + list(df.columns), 
+                        key=f"map_{h}"
+                    )
+
+            # 3. Export Area
+            st.markdown("<br>", unsafe_allow_html=True)
+            if st.button("🚀 Process & Generate Excel"):
+                # Identical file + mapping reuses the workbook already built
+                xlsx_key = (pdf_key, tuple(mapping.items()))
+                if st.session_state.get("xlsx_key") != xlsx_key:
+                    # Build output DataFrame based on user mapping
+                    out_df = pd.concat(
+                        [df[mapped_col].rename(h) if mapped_col != "(Ignore)" else pd.Series("", index=df.index, name=h)
+                         for h, mapped_col in mapping.items()],
+                        axis=1
+                    )
+                
+                    # Save to Excel buffer
+                    st.session_state.xlsx_output = to_excel_bytes(out_df)
+                    st.session_state.xlsx_key = xlsx_key
+                st.balloons()
+
+            if 'xlsx_output' in st.session_state:
+                st.download_button(
+                    label="📥 Download Excel File",
+                    data=st.session_state.xlsx_output,
+                    file_name="bbs_converted_data.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+        else:
+            st.error("No valid BBS tables found. Ensure the PDF contains headers like 'Bar Mark' and 'Type'.")
 
 st.markdown("---")
 st.caption("This tool is hosted on Streamlit Cloud for long-term free maintenance.")
@@ -0,0 +1,17 @@
+import os
+import tempfile
+
+import camelot
+
+# Code that runs inside the spawned Camelot workers. It lives outside app.py because Streamlit
+# executes app.py as __main__, and functions defined there can't be pickled for "spawn".
+
+def init_worker(scratch_dir):
+    # Point this worker's temp files (Camelot's scratch dirs, Ghostscript renders) at scratch_dir
+    if scratch_dir:
+        os.environ["TMPDIR"] = scratch_dir
+        tempfile.tempdir = scratch_dir
+
+def read_frames(pdf_path, pages, flavor):
+    # Only the cell DataFrames go back through the pipe; a pickled TableList is far larger
+    return [t.df for t in camelot.read_pdf(pdf_path, pages=pages, flavor=flavor)]